@@ -31,5 +31,6 @@ def initialize(app):
     admin.add_view(ModelView(models.Species))
     admin.add_view(ModelView(models.Image))
     admin.add_view(ModelView(models.Observation))
+    admin.add_view(ModelView(models.UserReliability))
 
     return admin
\ No newline at end of file
@@ -2,6 +2,7 @@
 # the main server app
 import sys
 import logging
+import uuid
 from datetime import datetime  as dt
 
 # server parameters
@@ -10,7 +11,7 @@ PORT = 5000
 DEBUG = False
 
 # basic flask imports
-from flask import (abort, Flask, flash, g, get_flashed_messages, redirect, render_template, request, url_for)
+from flask import (abort, Flask, flash, g, get_flashed_messages, jsonify, redirect, render_template, request, url_for)
 
 # flask bootstrap
 from flask_bootstrap import Bootstrap
@@ -23,6 +24,7 @@ from flask_login import (LoginManager, UserMixin, login_user, login_required,
 import forms
 import models
 import admin
+import archive
 
 # my local utilities
 from utils import get_object_or_404
@@ -186,35 +188,43 @@ def profile_original():
         )
     # get all species
     species_dict = models.species_dict()
+    # per species observation counts for current user, from the counter table
+    counts = dict(models.UserSpeciesCount.select(
+        models.UserSpeciesCount.species, models.UserSpeciesCount.total
+    ).where(models.UserSpeciesCount.user == g.user._get_current_object()).tuples())
     species_master = {}
     for species_name, species_data in species_dict.items():
-        # get observations on the particular species for current user
-        obs = models.Observation.select().where(
-            models.Observation.user == g.user._get_current_object(),
-            models.Observation.species == species_data.get('id')
-        )
         # update a "personalized" species_master dictionary, which is sent out for rendering in the template
-        species_data.update({'count':len(obs)})
+        species_data.update({'count':counts.get(species_data.get('id'), 0)})
         species_master.update({species_name:species_data})
         
-        # get last 5 observations
-        all_obs = models.Observation.select().where(models.Observation.user == g.user._get_current_object())
-        obs_limit = 10
-        if len(all_obs) < obs_limit:
-            obs_limit = len(obs)
+    # get last 10 observations
+    all_obs = (models.Observation
+               .select(models.Observation, models.Image)
+               .join(models.Image)
+               .where(models.Observation.user == g.user._get_current_object())
+               .order_by(models.Observation.id.desc())
+               .limit(10))
             
-    return render_template('profile.html', species_master=species_master, obs=all_obs[:obs_limit], talk=talk)
+    return render_template('profile.html', species_master=species_master, obs=all_obs, talk=talk)
 
 @app.route('/profile/<int:species_id>')
 @login_required
 def profile_species(species_id):
     """Show a listing of observations of a particular species by the user"""
     species = get_object_or_404(models.Species, species_id)
-    obs = models.Observation.select().where(models.Observation.user==g.user._get_current_object(),
-                                            models.Observation.species==species_id)
+    # keyset pagination, ?before=<id of last observation shown>
+    before = request.args.get('before', None, type=int)
+    obs = models.user_species_observations(g.user._get_current_object(), species_id, before=before)
+    next_before = obs[-1].id if len(obs) == models.OBS_PAGE_SIZE else None
+    # the listing is live only, archived seasons are counted on the profile
+    archived = models.ArchivedObservation.select().where(
+        models.ArchivedObservation.user == g.user._get_current_object(),
+        models.ArchivedObservation.species == species_id).exists()
     
     # todo decorate this with species info from SnapShot Serengeti
-    return render_template('observe_species.html', obs=obs, species=species)
+    return render_template('observe_species.html', obs=obs, species=species, next_before=next_before,
+                           archived=archived)
 
 @app.route('/observe_view/<int:obs_id>')
 @login_required
@@ -290,12 +300,13 @@ def _observe_save(image_id, count, species, next_id=0):
             return redirect(url_for('observe',image_id=image_id))
     
     try:
-        # save the observation
-        models.Observation.create(
+        # save the observation, a retried click updates rather than duplicates
+        models.Observation.save_observation(
             user=g.user._get_current_object(),
             image=image_id,
             count=count,
-            species=species_id
+            species=species_id,
+            key=request.args.get('key')
         )
         # move on to next_id (if zero, it is a random image)
         return redirect(url_for('observe', image_id=next_id))
@@ -353,11 +364,12 @@ def observe(image_id=0):
 
         # save the observation
         try:
-            models.Observation.create(
+            models.Observation.save_observation(
                 user=g.user._get_current_object(),
                 image=image.id,
                 species=user_identified_species_id,
-                count=count
+                count=count,
+                key=request.form.get('key')
             )
             # flash('Observation saved-- species="{}"'.format(name), category='success')
             return redirect(url_for('observe', image_id=image.id))
@@ -376,7 +388,9 @@ def observe(image_id=0):
         models.Talk.image == image
     )
     
-    return render_template('observe.html', image=image, species=species, obs=obs, talk=talk, talkform=talkform)
+    # a fresh idempotency key per rendered form, so a resubmitted POST is saved once
+    key = uuid.uuid4().hex
+    return render_template('observe.html', image=image, species=species, obs=obs, talk=talk, talkform=talkform, key=key)
 
 @app.route('/show/<int:image_id>')
 def image_show(image_id):
@@ -405,10 +419,106 @@ def observe_delete(item_id):
     app.logger.warning('failed delete of observation user={}, observation={}'.format(g.user, item_id))
     abort(403) # the user is not allowed to delete this observation
         
+@app.route('/_observe/overlay/<int:obs_id>', methods=('GET', 'POST'))
+@login_required
+def _observe_overlay(obs_id):
+    """get or set the boxes/points overlay of an observation as JSON
+    POST {"boxes": [[x0, y0, x1, y1], ...], "points": [[x, y], ...]}
+    """
+    observation = get_object_or_404(models.Observation, obs_id)
+    if request.method == 'POST':
+        if not (observation.user_id == g.user.id or g.user.is_admin):
+            app.logger.warning('failed overlay save user={}, observation={}'.format(g.user, obs_id))
+            abort(403) # the user is not allowed to change this observation
+        try:
+            observation.overlay = request.get_json(force=True)
+            observation.save()
+        except (ValueError, TypeError, AttributeError) as e:
+            app.logger.warning('bad overlay for observation={}: {}'.format(obs_id, e))
+            abort(400)
+    return jsonify(observation.overlay)
+
+# project modules each --serve worker imports from disk, so a HUP picks up deployed code
+LOCAL_MODULES = ('app', 'models', 'forms', 'admin', 'utils',
+                 'archive', 'imagesync', 'overlays', 'reliability')
+
+def create_app(config=None):
+    """returns the configured app with warm caches (used by --serve and external WSGI servers)
+    e.g. gunicorn 'app:create_app()'
+    """
+    if config:
+        app.config.update(config)
+    models.warm_caches()
+    return app
+
+def load_app():
+    """import a fresh copy of the app by name, called in each worker"""
+    import importlib
+    for name in LOCAL_MODULES:
+        sys.modules.pop(name, None)
+    return importlib.import_module('app').create_app()
+
+def post_fork(server, worker):
+    """runs in each worker after fork, workers must not share the master's DB handle"""
+    if not models.DATABASE.is_closed():
+        models.DATABASE.close()
+    app.logger.info('worker {} started @ {}'.format(worker.pid, dt.now()))
+
+def serve(host=HOST, port=PORT, workers=None, threads=1):
+    """runs a pre-forking multi-process gunicorn server
+    send SIGHUP to the master process for a graceful reload of the workers, new workers
+    re-import the code and reload the species cache (needed after --loadspecies)
+    """
+    import multiprocessing
+    from gunicorn.app.base import BaseApplication
+
+    if workers is None:
+        workers = multiprocessing.cpu_count() * 2 + 1
+
+    class GunicornApp(BaseApplication):
+        def __init__(self, options):
+            self.options = options
+            super(GunicornApp, self).__init__()
+
+        def load_config(self):
+            for key, value in self.options.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            # not the master's app object, so reloaded workers run the code on disk
+            return load_app()
+
+    options = {
+        'bind': '{}:{}'.format(host, port),
+        'workers': workers,
+        'threads': threads,
+        'worker_class': 'gthread' if threads > 1 else 'sync',
+        'post_fork': post_fork,
+        'accesslog': '-',
+    }
+    # the master must not hold an open connection across the fork
+    if not models.DATABASE.is_closed():
+        models.DATABASE.close()
+    app.logger.info('app serving host={}, port={}, workers={}, threads={}'.format(host, port, workers, threads))
+    GunicornApp(options).run()
+
+def get_arg(args, name, default=None, cast=str):
+    """returns the value following a command line switch, or default"""
+    if name in args:
+        try:
+            return cast(args[args.index(name) + 1])
+        except (IndexError, ValueError):
+            print("ERROR: bad or missing value for {}".format(name))
+            sys.exit(1)
+    return default
+
 if __name__ == '__main__':
     args = sys.argv
     # override args if needed below
     # args.append('--runserver')
+    # --host and --port may be combined with any of the run modes
+    HOST = get_arg(args, '--host', HOST)
+    PORT = get_arg(args, '--port', PORT, int)
     if '--createsuperuser' in args:
         models.create_superuser()
         app.logger.info('creating admin user initiated')
@@ -417,15 +527,58 @@ if __name__ == '__main__':
         models.update_images(args)
         print("** image update complete **")
         sys.exit(0)
+    elif '--loadspecies' in args:
+        app.logger.info('species load begin')
+        models.species_init()
+        app.logger.info('species load completed')
+        print("** species loaded, send SIGHUP to a running --serve master to refresh its cache **")
+    elif '--archive' in args:
+        options = dict(arg.split('=', 1) for arg in args if '=' in arg)
+        if 'name' not in options or not ('before' in options or 'site' in options):
+            print("ERROR: must specify name=<archive> and before=YYYY-MM-DD and/or site=<site>")
+            sys.exit(1)
+        before = archive.parse_date(options['before']) if 'before' in options else None
+        app.logger.info('archive {} begin'.format(options['name']))
+        moved = archive.run(options['name'], before=before, site=options.get('site'))
+        app.logger.info('archive {} completed {}'.format(options['name'], moved))
+        print("** archive complete **")
+        sys.exit(0)
+    elif '--reliability' in args:
+        import reliability
+        app.logger.info('reliability scoring begin')
+        processed = reliability.run(full='full' in args)
+        app.logger.info('reliability scoring completed, {} images'.format(processed))
+        print("** {} images scored **".format(processed))
+    elif '--rebuildcounters' in args:
+        app.logger.info('counter rebuild begin')
+        models.rebuild_counters()
+        app.logger.info('counter rebuild completed')
+        print("** observation counters rebuilt **")
+    elif '--syncimages' in args:
+        import imagesync
+        options = models.image_args(args)
+        if options['file']:
+            paths = imagesync.listing_paths(options['file'])
+        elif options['dir']:
+            paths = imagesync.directory_paths(options['dir'])
+        else:
+            print("ERROR: must specify file=<listing> or dir=<media directory>")
+            sys.exit(1)
+        app.logger.info('image sync begin')
+        counts = imagesync.sync(paths, options['baseurl'], retire='retire' in args, moves='moves' in args)
+        app.logger.info('image sync completed {}'.format(counts))
+        print("** image sync complete **")
+        sys.exit(0)
+    elif '--dedupeobservations' in args:
+        app.logger.info('observation deduplication begin')
+        removed = models.dedupe_observations()
+        app.logger.info('observation deduplication completed, {} rows removed'.format(removed))
+        print("** {} duplicate observations removed **".format(removed))
     elif '--initdatabase' in args:
         app.logger.info('database initialize begin')
         models.initialize_database()
         app.logger.info('database initialize completed')
         print("** database initialized **")
-    elif '--host' in args:
-        PORT = args[args.index('--host') + 1]
-    elif '--port' in args:
-        PORT = int(args[args.index('--port') + 1])
     elif '--runserver' in args:
         # see settings at the top of the file
         app.logger.info('app started host={}, port={}'.format(HOST,PORT))
@@ -434,6 +587,10 @@ if __name__ == '__main__':
         from paste import httpserver
         app.logger.info('app started host={}, port={}'.format(HOST,PORT))
         httpserver.serve(app, host=HOST, port=PORT)
+    elif '--serve' in args:
+        serve(host=HOST, port=PORT,
+              workers=get_arg(args, '--workers', None, int),
+              threads=get_arg(args, '--threads', 1, int))
     else:
         msg = """
         app.py valid command line options
@@ -441,7 +598,20 @@ if __name__ == '__main__':
         --port (default = 5000, defines which port server will run on)
         --createsuperuser (allows creation of an administrative user)
         --initdatabase (initializes the database if required)
+        --updateimages file=<listing> [baseurl=<url>] (adds images from a listing file)
+        --syncimages file=<listing>|dir=<media dir> [baseurl=<url>] [retire] [moves]
+            (adds and reports removed images, retire takes removed ones out of the queue,
+            moves re-points images whose parent folder and file name moved to a new path)
+        --dedupeobservations (collapses duplicate observations, adds unique index, prunes expired save keys)
+        --loadspecies (loads/updates the species table from data/species_table.ser)
+        --rebuildcounters (recomputes the per-user observation counters)
+        --archive name=<archive> before=YYYY-MM-DD|site=<site> (moves old observations and talk
+            to archive/<archive>.db and verifies the row counts)
+        --reliability [full] (scores user agreement with the plurality, only changed images unless full)
         --runserver (runs the server on port configured in source code)
         --paste (runs a paste wsgi server on port configured in source code)
+        --serve (runs a multi-process gunicorn server, SIGHUP reloads workers gracefully)
+            --workers N (default = 2 * cores + 1)
+            --threads N (default = 1, threads per worker)
         """
         print(msg)
@@ -0,0 +1,187 @@
+# archive.py
+# moves old observations and talk out of the live database into archive database files
+#
+# run from the command line with:
+#   python app.py --archive name=2016 before=2017-01-01 [site=TAW_2]
+# archives are attached read-only for merged reads (consensus, export), the observe
+# pages only ever touch the live tables (ArchivedObservation records what was moved)
+from contextlib import contextmanager
+import datetime
+import os
+
+from models import DATABASE, ArchivedObservation
+
+ARCHIVE_DIR = 'archive'
+# sqlite attaches at most 10 databases per connection, merged reads attach them all,
+# so keep archives coarse, e.g. one per season rather than one per site
+MAX_ARCHIVES = 10
+# rows moved per transaction
+BATCH = 500
+# tables that are archived
+TABLES = ('observation', 'talk')
+
+
+def archive_paths():
+    """archive database files, oldest name first"""
+    if not os.path.isdir(ARCHIVE_DIR):
+        return []
+    return sorted(os.path.join(ARCHIVE_DIR, f) for f in os.listdir(ARCHIVE_DIR) if f.endswith('.db'))
+
+
+@contextmanager
+def attached():
+    """attach every archive read-only on the current connection, yields the schema names
+    raises RuntimeError when there are more than MAX_ARCHIVES
+    """
+    paths = archive_paths()
+    if len(paths) > MAX_ARCHIVES:
+        raise RuntimeError('{} archives in {}, at most {} can be attached, merge some of them'
+                           .format(len(paths), ARCHIVE_DIR, MAX_ARCHIVES))
+    schemas = []
+    try:
+        for n, path in enumerate(paths):
+            schema = 'archive_{}'.format(n)
+            DATABASE.execute_sql('ATTACH DATABASE ? AS {}'.format(schema),
+                                 ('file:{}?mode=ro'.format(os.path.abspath(path)),))
+            schemas.append(schema)
+        yield schemas
+    finally:
+        for schema in schemas:
+            DATABASE.execute_sql('DETACH DATABASE {}'.format(schema))
+
+
+def union_sql(schemas, table, columns, where=''):
+    """SELECT over the live table and the same table in each attached archive"""
+    where = ' WHERE {}'.format(where) if where else ''
+    return ' UNION ALL '.join('SELECT {} FROM {}.{}{}'.format(', '.join(columns), schema, table, where)
+                              for schema in ['main'] + list(schemas))
+
+
+def merged_rows(table, columns, where='', params=(), order_by=None):
+    """stream rows of a table across the live and archive databases
+    where and params apply to each store, e.g. where='image_id = ?', params=(image_id,)
+    """
+    with attached() as schemas:
+        sql = union_sql(schemas, table, columns, where)
+        if order_by:
+            sql += ' ORDER BY {}'.format(order_by)
+        cursor = DATABASE.execute_sql(sql, tuple(params) * (len(schemas) + 1))
+        for row in cursor:
+            yield row
+
+
+def record_archived():
+    """fill ArchivedObservation from the archive files, for archives made before it existed
+    attaches one archive at a time, returns the number of (user, image, species) recorded
+    """
+    DATABASE.create_tables([ArchivedObservation], safe=True)
+    recorded = 0
+    for path in archive_paths():
+        DATABASE.execute_sql('ATTACH DATABASE ? AS archive', ('file:{}?mode=ro'.format(os.path.abspath(path)),))
+        try:
+            with DATABASE.atomic():
+                recorded += DATABASE.execute_sql(
+                    'INSERT OR IGNORE INTO main.archivedobservation (user_id, image_id, species_id) '
+                    'SELECT DISTINCT user_id, image_id, species_id FROM archive.observation').rowcount
+        finally:
+            DATABASE.execute_sql('DETACH DATABASE archive')
+    return recorded
+
+
+def _criteria(table, before=None, site=None):
+    """WHERE clause and params selecting the rows of table to archive"""
+    clauses, params = [], []
+    if before is not None:
+        clauses.append('{}.timestamp < ?'.format(table))
+        # timestamps are stored as text, compare in the same format
+        params.append(str(before))
+    if site is not None:
+        clauses.append('{}.image_id IN (SELECT id FROM main.image WHERE filepath LIKE ?)'.format(table))
+        params.append(site.rstrip('/') + '/%')
+    if not clauses:
+        raise ValueError('archive needs before= and/or site=')
+    return ' AND '.join(clauses), params
+
+
+def _count(schema, table, where='', params=()):
+    where = ' WHERE {}'.format(where) if where else ''
+    return DATABASE.execute_sql('SELECT COUNT(*) FROM {}.{}{}'.format(schema, table, where),
+                                tuple(params)).fetchone()[0]
+
+
+def _columns(table):
+    return [row[1] for row in DATABASE.execute_sql('PRAGMA main.table_info({})'.format(table))]
+
+
+def _move(table, where, params, batch):
+    """move matching rows of table into the attached 'archive' schema, returns rows moved"""
+    columns = ', '.join(_columns(table))
+    moved = 0
+    while True:
+        ids = [row[0] for row in DATABASE.execute_sql(
+            'SELECT id FROM main.{0} WHERE {1} ORDER BY id LIMIT {2}'.format(table, where, batch),
+            tuple(params))]
+        if not ids:
+            return moved
+        marks = ', '.join('?' * len(ids))
+        with DATABASE.atomic():
+            DATABASE.execute_sql('INSERT INTO archive.{0} ({1}) SELECT {1} FROM main.{0} WHERE id IN ({2})'
+                                 .format(table, columns, marks), ids)
+            if table == 'observation':
+                # saves check this instead of attaching the archives
+                DATABASE.execute_sql('INSERT OR IGNORE INTO main.archivedobservation (user_id, image_id, species_id) '
+                                     'SELECT user_id, image_id, species_id FROM main.observation WHERE id IN ({})'
+                                     .format(marks), ids)
+                # replay keys of archived observations are stale
+                DATABASE.execute_sql('DELETE FROM main.idempotencykey WHERE observation_id IN ({})'
+                                     .format(marks), ids)
+            DATABASE.execute_sql('DELETE FROM main.{} WHERE id IN ({})'.format(table, marks), ids)
+        moved += len(ids)
+        print("{} {} rows archived".format(moved, table))
+
+
+def run(name, before=None, site=None, batch=BATCH):
+    """move observations and talk saved before a date and/or on a site into ARCHIVE_DIR/<name>.db
+    the per user counters are left alone, archived observations still count (once, a later
+    save of the same user, image and species in the live table is not counted again)
+    row counts are verified afterwards, returns {table: rows moved}
+    raises ValueError rather than start an archive past MAX_ARCHIVES
+    """
+    if not os.path.isdir(ARCHIVE_DIR):
+        os.makedirs(ARCHIVE_DIR)
+    path = os.path.join(ARCHIVE_DIR, '{}.db'.format(name))
+    if not os.path.exists(path) and len(archive_paths()) >= MAX_ARCHIVES:
+        raise ValueError('already {} archives, add to an existing one (e.g. name={}) instead'
+                         .format(MAX_ARCHIVES, os.path.splitext(os.path.basename(archive_paths()[-1]))[0]))
+    DATABASE.connect()
+    DATABASE.create_tables([ArchivedObservation], safe=True)
+    DATABASE.execute_sql('ATTACH DATABASE ? AS archive', (path,))
+    try:
+        moved = {}
+        for table in TABLES:
+            # same columns as the live table, without the constraints
+            DATABASE.execute_sql('CREATE TABLE IF NOT EXISTS archive.{0} AS SELECT * FROM main.{0} WHERE 0'
+                                 .format(table))
+            for column in ('image_id', 'user_id', 'timestamp'):
+                DATABASE.execute_sql('CREATE INDEX IF NOT EXISTS archive.{0}_{1} ON {0} ({1})'
+                                     .format(table, column))
+            where, params = _criteria(table, before, site)
+            expected = _count('main', table, where, params)
+            archived_before = _count('archive', table)
+            moved[table] = _move(table, where, params, batch)
+            # verify nothing was lost or left behind
+            archived = _count('archive', table) - archived_before
+            left = _count('main', table, where, params)
+            if archived != moved[table] or moved[table] < expected or left:
+                raise RuntimeError('{} archive check failed: expected {}, moved {}, archived {}, left {}'
+                                   .format(table, expected, moved[table], archived, left))
+            print("{}: {} rows archived to {}, verified".format(table, moved[table], path))
+        return moved
+    finally:
+        DATABASE.execute_sql('DETACH DATABASE archive')
+        DATABASE.close()
+
+
+def parse_date(value):
+    """YYYY-MM-DD command line date"""
+    return datetime.datetime.strptime(value, '%Y-%m-%d')
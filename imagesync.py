@@ -0,0 +1,213 @@
+# imagesync.py
+# reconcile the Image table with a media listing file or a local media directory
+#
+# run from the command line with:
+#   python app.py --syncimages file=data/images.txt [baseurl=http://...] [retire] [moves]
+#   python app.py --syncimages dir=/srv/media/sites [baseurl=http://...] [retire] [moves]
+import heapq
+import os
+import tempfile
+
+from models import DATABASE, Image, add_column
+
+# paths sorted in memory before spilling a sorted run to disk
+SORT_CHUNK = 500000
+# rows per transaction when applying changes
+BATCH = 1000
+# sqlite bound variable limit is 999, keep IN lists and inserts well under it
+CHUNK = 100
+
+
+def normalize(line):
+    """listing line to Image.filepath, or None if it is not an image"""
+    line = line.strip()
+    if '.JPG' not in line.upper():
+        return None
+    # remove leading relative path './'
+    if line[:2] == './':
+        line = line[2:]
+    return line
+
+
+def listing_paths(fname):
+    """stream image paths from a listing file (e.g. the output of find)"""
+    with open(fname, "r") as fp:
+        for line in fp:
+            path = normalize(line)
+            if path:
+                yield path
+
+
+def directory_paths(root):
+    """stream image paths under a local media directory, relative to root"""
+    for dirpath, dirnames, filenames in os.walk(root):
+        rel = os.path.relpath(dirpath, root)
+        for name in filenames:
+            path = normalize(name if rel == '.' else os.path.join(rel, name).replace(os.sep, '/'))
+            if path:
+                yield path
+
+
+def _spill(lines):
+    fp = tempfile.TemporaryFile(mode='w+')
+    fp.writelines(line + '\n' for line in lines)
+    fp.seek(0)
+    return fp
+
+
+def sorted_unique(paths, chunk_size=SORT_CHUNK):
+    """external merge sort, memory is bounded by chunk_size paths"""
+    runs, chunk = [], []
+    for path in paths:
+        chunk.append(path)
+        if len(chunk) >= chunk_size:
+            chunk.sort()
+            runs.append(_spill(chunk))
+            chunk = []
+    chunk.sort()
+    runs.append(_spill(chunk))
+    last = None
+    for line in heapq.merge(*runs):
+        path = line.rstrip('\n')
+        if path != last:
+            yield path
+            last = path
+    for fp in runs:
+        fp.close()
+
+
+def diff(paths):
+    """sorted merge of listing paths against Image.filepath
+    returns temp files of added paths and removed 'id path' lines, and a list of restored ids
+    """
+    added = tempfile.TemporaryFile(mode='w+')
+    removed = tempfile.TemporaryFile(mode='w+')
+    restored = []
+    images = (Image
+              .select(Image.id, Image.filepath, Image.retired)
+              .order_by(Image.filepath)
+              .tuples()
+              .iterator())
+    current = next(images, None)
+    for path in paths:
+        while current is not None and current[1] < path:
+            if not current[2]:
+                removed.write('{} {}\n'.format(current[0], current[1]))
+            current = next(images, None)
+        if current is not None and current[1] == path:
+            if current[2]:
+                restored.append(current[0])
+            current = next(images, None)
+        else:
+            added.write(path + '\n')
+    while current is not None:
+        if not current[2]:
+            removed.write('{} {}\n'.format(current[0], current[1]))
+        current = next(images, None)
+    added.seek(0)
+    removed.seek(0)
+    return added, removed, restored
+
+
+def _lines(fp):
+    fp.seek(0)
+    for line in fp:
+        yield line.rstrip('\n')
+
+
+def _move_key(path):
+    """parent folder and file name, camera trap file names alone repeat across sites"""
+    parts = path.rsplit('/', 2)
+    return '/'.join(parts[-2:]) if len(parts) > 1 else None
+
+
+def find_moves(added, removed):
+    """match removed and added paths by parent folder and file name, when that is unique
+    on both sides (e.g. a site folder moved under a new root)
+    memory is bounded by the number of removed paths, not by the listing
+    returns {image_id: (old filepath, new filepath)}
+    """
+    removed_by_key = {}
+    for line in _lines(removed):
+        image_id, path = line.split(' ', 1)
+        key = _move_key(path)
+        if key:
+            removed_by_key[key] = None if key in removed_by_key else (int(image_id), path)
+    if not removed_by_key:
+        return {}
+    candidates = {}
+    for path in _lines(added):
+        key = _move_key(path)
+        if removed_by_key.get(key) is not None:
+            candidates[key] = None if key in candidates else path
+    return dict((removed_by_key[key][0], (removed_by_key[key][1], path))
+                for key, path in candidates.items() if path)
+
+
+def _batched(items, size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def apply(added, removed, restored, moves, base_url, retire=False):
+    """apply the diff in batched transactions, returns a dict of counts"""
+    moved_to = set(new for old, new in moves.values())
+    counts = {'added': 0, 'moved': len(moves), 'restored': len(restored), 'removed': 0, 'retired': 0}
+
+    for batch in _batched(moves.items(), BATCH):
+        with DATABASE.atomic():
+            for image_id, (old, path) in batch:
+                Image.update(filepath=path, retired=False).where(Image.id == image_id).execute()
+
+    new_paths = (path for path in _lines(added) if path not in moved_to)
+    for batch in _batched(new_paths, BATCH):
+        with DATABASE.atomic():
+            for start in range(0, len(batch), CHUNK):
+                Image.insert_many([{'filepath': path, 'base_url': base_url, 'site': ''}
+                                   for path in batch[start:start + CHUNK]]).execute()
+        counts['added'] += len(batch)
+
+    for batch in _batched(restored, BATCH):
+        with DATABASE.atomic():
+            for start in range(0, len(batch), CHUNK):
+                Image.update(retired=False).where(Image.id << batch[start:start + CHUNK]).execute()
+
+    gone = (int(line.split(' ', 1)[0]) for line in _lines(removed))
+    for batch in _batched((image_id for image_id in gone if image_id not in moves), BATCH):
+        counts['removed'] += len(batch)
+        if retire:
+            with DATABASE.atomic():
+                for start in range(0, len(batch), CHUNK):
+                    counts['retired'] += Image.update(retired=True).where(
+                        Image.id << batch[start:start + CHUNK]).execute()
+    return counts
+
+
+def sync(paths, base_url, retire=False, moves=False):
+    """reconcile Image with an iterable of image paths
+    images no longer listed are reported, and retired (left out of the classification queue)
+    when retire is set; rows are never deleted, so their observations are kept
+    with moves set, removed and added paths with the same parent folder and file name
+    re-point the existing image (and its observations), each move is printed first
+    """
+    DATABASE.connect()
+    try:
+        add_column('image', 'retired', 'INTEGER NOT NULL DEFAULT 0')
+        added, removed, restored = diff(sorted_unique(paths))
+        moves = find_moves(added, removed) if moves else {}
+        for image_id, (old, new) in sorted(moves.items()):
+            print("move image {}: {} -> {}".format(image_id, old, new))
+        counts = apply(added, removed, restored, moves, base_url, retire=retire)
+        added.close()
+        removed.close()
+    finally:
+        DATABASE.close()
+    print("images added={added} moved={moved} restored={restored} "
+          "removed={removed} retired={retired}".format(**counts))
+    return counts
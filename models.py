@@ -1,9 +1,11 @@
 # python imports
+import collections
 import datetime
 import json
 from operator import itemgetter
 import os
 from random import randint
+import struct
 import sys
 
 
@@ -17,10 +19,19 @@ from peewee import *
 # magic from flask_login
 from flask_login import UserMixin
 
-DATABASE = SqliteDatabase('app.db')
+# uri=True lets archive.py attach archive databases read-only
+# WAL and a busy timeout let the --serve worker processes write without 'database is locked'
+DATABASE = SqliteDatabase('app.db', uri=True,
+                          pragmas=(('journal_mode', 'wal'), ('busy_timeout', 5000)))
 
 IMAGE_COUNT = 112710
 
+# rows per page on the observation drill-down
+OBS_PAGE_SIZE = 50
+
+# how long a save request key is kept for replays (a client retry window, not history)
+KEY_TTL = datetime.timedelta(days=1)
+
 # model definitions
 class BaseModel(Model):
     class Meta:
@@ -61,26 +72,58 @@ class User(UserMixin, BaseModel):
     
     def observations(self):
         """return number of observations made for leaderboard"""
-        obs = Observation.select().where(Observation.user==self)
-        return len(obs)
+        try:
+            return UserTotal.get(UserTotal.user == self).total
+        except DoesNotExist:
+            return 0
     
     class Meta:
         order_by = ('-username',)
     
+# boolean species traits from the fixture, the position is the bit in Species.traits
+# only ever append to this tuple, reordering changes the meaning of stored masks
+TRAITS = ('insectivore', 'carnivore', 'herbivore', 'omnivore', 'browser', 'grazer',
+          'SNSBr', 'MSMix', 'LBr', 'WDGr', 'Nrum')
+
+def trait_mask(*names):
+    """bitmask for the named traits, raises KeyError on an unknown trait"""
+    mask = 0
+    for name in names:
+        if name not in TRAITS:
+            raise KeyError(name)
+        mask |= 1 << TRAITS.index(name)
+    return mask
+
+def fields_mask(fields):
+    """bitmask of the traits set in a fixture/Species.data dictionary"""
+    return trait_mask(*[name for name in TRAITS if fields.get(name)])
+
 class Species(BaseModel):
-    """species model includes a name, ref_url and data"""
+    """species model includes a name, ref_url and traits"""
     name = CharField(unique=True)
     # ref_url is used to prompt a user on possible page with species details
     ref_url = CharField(max_length=100, default='')
-    # data is a pseudo-JSON element
+    # data is a pseudo-JSON element, the fixture record (traits are read from the bitmask)
     data = TextField(default='')
+    # bitmask of TRAITS, filtered with a bit test (traits & mask), so not indexed
+    traits = IntegerField(default=0)
     
     def __dict__(self):
-        return json.loads(self.data)
+        item = {'name': self.name, 'ref_url': self.ref_url}
+        item.update((name, bool(self.traits & (1 << bit))) for bit, name in enumerate(TRAITS))
+        return item
     
     def isa(self, prop):
         """species.isa('carnivore') = True or False (None of no property set)"""
-        return self.__dict__().get(prop, None)
+        if prop not in TRAITS:
+            return None
+        return bool(self.traits & trait_mask(prop))
+
+    @classmethod
+    def having_traits(cls, *names):
+        """select species having all of the named traits, e.g. Species.having_traits('carnivore')"""
+        mask = trait_mask(*names)
+        return cls.select().where(cls.traits.bin_and(mask) == mask)
         
     def __repr__(self):
         return self.name
@@ -88,6 +131,57 @@ class Species(BaseModel):
     def __str__(self):
         return self.name
 
+def add_column(table, column, ddl, index=True):
+    """add a column (indexed unless index=False) to a table created by an older version
+    of this module, returns True when the column was added
+    """
+    if table not in DATABASE.get_tables():
+        return False
+    if column in [c.name for c in DATABASE.get_columns(table)]:
+        return False
+    DATABASE.execute_sql('ALTER TABLE {} ADD COLUMN {} {}'.format(table, column, ddl))
+    if index:
+        add_index(table, [column])
+    return True
+
+def add_traits_column():
+    """add Species.traits to an older database and fill it from the JSON in Species.data"""
+    # an index on traits only cost writes, having_traits() cannot use it
+    DATABASE.execute_sql('DROP INDEX IF EXISTS species_traits')
+    if not add_column('species', 'traits', 'INTEGER NOT NULL DEFAULT 0', index=False):
+        return
+    with DATABASE.atomic():
+        for species_id, data in Species.select(Species.id, Species.data).tuples():
+            try:
+                fields = json.loads(data)
+            except ValueError:
+                continue
+            Species.update(traits=fields_mask(fields)).where(Species.id == species_id).execute()
+
+def add_index(table, columns, unique=False):
+    """create an index on an existing table, named the way peewee names Meta indexes"""
+    DATABASE.execute_sql('CREATE {}INDEX IF NOT EXISTS {}_{} ON {} ({})'.format(
+        'UNIQUE ' if unique else '', table, '_'.join(columns), table, ', '.join(columns)))
+
+def has_duplicate_observations():
+    """True if some (user, image, species) has more than one observation row"""
+    return DATABASE.execute_sql(
+        'SELECT 1 FROM observation GROUP BY user_id, image_id, species_id HAVING COUNT(*) > 1 LIMIT 1'
+    ).fetchone() is not None
+
+def observation_indexes():
+    """add the Observation indexes to a table created by an older version of this module
+    the unique index waits until duplicates are gone, returns True once it exists
+    """
+    # backs the keyset paginated drill-down, the rowid gives the id order
+    add_index('observation', ['user_id', 'species_id'])
+    add_index('observation', ['timestamp'])
+    if has_duplicate_observations():
+        print("duplicate observations found, run --dedupeobservations to add the unique index")
+        return False
+    add_index('observation', ['user_id', 'image_id', 'species_id'], unique=True)
+    return True
+
 def initialize_database():
     """drop tables and init images with caution, this takes a LONG time"""
     DATABASE.connect()
@@ -95,7 +189,27 @@ def initialize_database():
     # except: pass
     # try: DATABASE.drop_table(Image)
     # except: pass
-    DATABASE.create_tables([User,Species, Image, Observation, Talk], safe=True)
+    tables = DATABASE.get_tables()
+    # columns added since the tables were first created, before anything selects them
+    add_traits_column()
+    add_column('image', 'retired', 'INTEGER NOT NULL DEFAULT 0')
+    model_list = [User, Species, Image, Observation, IdempotencyKey, UserSpeciesCount, UserTotal,
+              ImageConsensus, ChangedImage, UserReliability, Talk, ArchivedObservation]
+    if 'observation' in tables:
+        # an older observation table may still hold duplicates the unique index would reject
+        model_list.remove(Observation)
+    DATABASE.create_tables(model_list, safe=True)
+    if 'observation' in tables:
+        observation_indexes()
+    # keys are pruned by age
+    add_index('idempotencykey', ['timestamp'])
+    if 'archivedobservation' not in tables:
+        # archives made before the table existed
+        import archive
+        archive.record_archived()
+    if 'usertotal' not in tables:
+        # first run with the counter tables, backfill them from existing observations
+        rebuild_counters()
     #species_init()
     # image_init()
 
@@ -131,21 +245,35 @@ def create_superuser():
         
 
     
-def species_init():
-    """initialize Species model with fixture data, JSON from SavanaHorizon included"""
-    fname = "data/species_table.ser"
+def species_init(fname="data/species_table.ser"):
+    """initialize Species model with fixture data, JSON from SavanaHorizon included
+    idempotent, new species are inserted and existing ones updated in one transaction
+    """
     with open(fname,"r") as fp:
         data = json.loads(fp.read())
+    rows = {}
     for item in data:
-        print(item)
         fields = item.get('fields')
-        try:
-            s = Species.get(Species.name==fields.get('name'))
-        except:
-            s = Species.create(name=fields.get('name'), ref_url=fields.get('ref_url'),
-                               data=json.dumps(fields))
-            s.save()
-            print("saving {}".format(s.name))
+        rows[fields.get('name')] = {
+            'name': fields.get('name'),
+            'ref_url': fields.get('ref_url') or '',
+            'data': json.dumps(fields),
+            'traits': fields_mask(fields),
+        }
+    # databases created before Species.traits existed need the column
+    add_traits_column()
+    created = updated = 0
+    with DATABASE.atomic():
+        existing = dict(Species.select(Species.name, Species.id).tuples())
+        new_rows = [row for name, row in rows.items() if name not in existing]
+        for start in range(0, len(new_rows), 100):
+            Species.insert_many(new_rows[start:start + 100]).execute()
+        created = len(new_rows)
+        for name, row in rows.items():
+            if name in existing:
+                updated += Species.update(ref_url=row['ref_url'], data=row['data'], traits=row['traits']).where(
+                    Species.id == existing[name]).execute()
+    print("species loaded, {} created, {} updated".format(created, updated))
 
 class Image(BaseModel):
     """Image model references a remote image base_url joined to filepath"""
@@ -154,6 +282,8 @@ class Image(BaseModel):
     filepath = CharField(unique=True)
     site = CharField()
     timestamp = DateTimeField(default=datetime.datetime.now)
+    # retired images are no longer on the media server, kept for their observations
+    retired = BooleanField(default=False, index=True)
     
     def url(self):
         return os.path.join(self.base_url, self.filepath)
@@ -161,19 +291,22 @@ class Image(BaseModel):
     def __repr__(self):
         return self.filepath
     
+def image_args(args):
+    """parse file=, dir= and baseurl= command line arguments into a dict"""
+    options = {'file': None, 'dir': None, 'baseurl': "http://media.itg.wfu.edu/sites/"}
+    for arg in args:
+        key, sep, value = arg.partition('=')
+        if sep and key in options:
+            options[key] = value
+    return options
+
 def update_images(args):
     """update images from a file.
     --updateimages file=data/images.txt baseurl=http://media.itg.wfu.edu/sites/
     """
-    fname = None
-    base_url = None
-    for arg in args:
-        if 'file=' in arg:
-            fname = arg.split('=')[1]
-        if 'baseurl=' in arg:
-            base_url = arg.split('=')[1]
-        else:
-            base_url = "http://media.itg.wfu.edu/sites/"
+    options = image_args(args)
+    fname = options['file']
+    base_url = options['baseurl']
     if fname is None:
         print("ERROR: must specify a filename, e.g. file=data/images.txt")
         return False
@@ -218,6 +351,40 @@ def image_init(fname, base_url="http://media.itg.wfu.edu/sites/"):
                 
     
     
+# overlay blob layout, all little endian:
+#   uint16 number of boxes, uint16 number of points,
+#   int16 x0, y0, x1, y1 per box, then int16 x, y per point (pixel coordinates)
+OVERLAY_HEADER = struct.Struct('<HH')
+
+def encode_overlay(value):
+    """pack {'boxes': [...], 'points': [...]} into the compact overlay blob"""
+    if not value:
+        return b''
+    boxes = [[int(v) for v in box] for box in value.get('boxes', [])]
+    points = [[int(v) for v in point] for point in value.get('points', [])]
+    if any(len(box) != 4 for box in boxes) or any(len(point) != 2 for point in points):
+        raise ValueError('boxes need 4 coordinates and points need 2')
+    coords = [v for box in boxes for v in box] + [v for point in points for v in point]
+    if any(v < -32768 or v > 32767 for v in coords):
+        raise ValueError('overlay coordinates must fit in int16')
+    return (OVERLAY_HEADER.pack(len(boxes), len(points)) +
+            struct.pack('<{}h'.format(len(coords)), *coords))
+
+def decode_overlay(blob):
+    """unpack an overlay blob, legacy empty or JSON text is still understood"""
+    if not blob:
+        return {'boxes': [], 'points': []}
+    if isinstance(blob, str):
+        value = json.loads(blob)
+        return {'boxes': value.get('boxes', []), 'points': value.get('points', [])}
+    blob = bytes(blob)
+    n_boxes, n_points = OVERLAY_HEADER.unpack_from(blob)
+    coords = struct.unpack_from('<{}h'.format(4 * n_boxes + 2 * n_points), blob, OVERLAY_HEADER.size)
+    return {
+        'boxes': [list(coords[n:n + 4]) for n in range(0, 4 * n_boxes, 4)],
+        'points': [list(coords[n:n + 2]) for n in range(4 * n_boxes, len(coords), 2)],
+    }
+    
 class Observation(BaseModel):
     """The observation model"""
     image = ForeignKeyField(Image, related_name="image")
@@ -225,22 +392,297 @@ class Observation(BaseModel):
     species = ForeignKeyField(Species, related_name="species")
     count = IntegerField(default=1)
     notes = TextField(default='')
-    _overlay = TextField(default='') # experimental JSON object
-    timestamp = DateTimeField(default=datetime.datetime.now)
+    _overlay = BlobField(default=b'') # packed boxes and points, see encode_overlay
+    # indexed, the reliability job looks up observations saved since its last run
+    timestamp = DateTimeField(default=datetime.datetime.now, index=True)
     
     @property
     def overlay(self):
-        return json.loads(self.overlay)
+        """{'boxes': [[x0, y0, x1, y1], ...], 'points': [[x, y], ...]}, decoded on access"""
+        return decode_overlay(self._overlay)
     
     @overlay.setter
     def overlay(self, value):
-        self._overlay = json.dumps(value)
+        self._overlay = encode_overlay(value)
     
     def __repr__(self):
         return "{}={} {} @ {}".format(self.species, self.count, self.user, self.timestamp)
     
+    @classmethod
+    def save_observation(cls, user, image, species, count=1, key=None):
+        """idempotent save, one row per (user, image, species)
+        an existing row has its count updated, a repeated client key is a no-op
+        returns the observation
+        """
+        # take the write lock up front, so concurrent replays of a key queue up behind it
+        with DATABASE.atomic(lock_type='IMMEDIATE'):
+            if key:
+                try:
+                    used = IdempotencyKey.get(IdempotencyKey.key == key)
+                    if used.user_id == getattr(user, 'id', user):
+                        return used.observation
+                    # another user's key, save without recording it
+                    key = None
+                except DoesNotExist:
+                    pass
+            try:
+                with DATABASE.atomic():
+                    # save() counts the new row
+                    obs = cls.create(user=user, image=image, species=species, count=count)
+            except IntegrityError:
+                # already observed, update the count in place
+                cls.update(count=count, timestamp=datetime.datetime.now()).where(
+                    cls.user == user, cls.image == image, cls.species == species
+                ).execute()
+                obs = cls.get(cls.user == user, cls.image == image, cls.species == species)
+            if key:
+                try:
+                    with DATABASE.atomic():
+                        IdempotencyKey.create(key=key, user=user, observation=obs)
+                except IntegrityError:
+                    # the key was recorded in the meantime, the first save wins
+                    return IdempotencyKey.get(IdempotencyKey.key == key).observation
+                # keys past the retry window, an indexed range so usually a no-op
+                IdempotencyKey.prune()
+        return obs
+
+    def save(self, *args, **kwargs):
+        """save and keep the user counters in step in one transaction, on insert and when an
+        update changes the user, image or species (admin creates and edits come through here)
+        """
+        with DATABASE.atomic():
+            old = None
+            if self.get_id() is not None and not kwargs.get('force_insert'):
+                old = (Observation
+                       .select(Observation.user, Observation.image, Observation.species)
+                       .where(Observation.id == self.get_id())
+                       .tuples()
+                       .first())
+            result = super(Observation, self).save(*args, **kwargs)
+            new = (self.user_id, self.image_id, self.species_id)
+            if old != new:
+                if old is not None:
+                    _count_observation(old[0], old[1], old[2], -1)
+                    # moved between images, both need rescoring
+                    ChangedImage.mark(old[1])
+                    ChangedImage.mark(new[1])
+                _count_observation(new[0], new[1], new[2], 1)
+        return result
+
+    def delete_instance(self, *args, **kwargs):
+        """delete the observation and decrement the user counters in one transaction"""
+        with DATABASE.atomic():
+            IdempotencyKey.delete().where(IdempotencyKey.observation == self.id).execute()
+            result = super(Observation, self).delete_instance(*args, **kwargs)
+            if result:
+                _count_observation(self.user_id, self.image_id, self.species_id, -1)
+                ChangedImage.mark(self.image_id)
+        return result
+    
     class Meta:
         order_by = ('-timestamp','user')
+        indexes = (
+            # one observation per user, image and species
+            (('user', 'image', 'species'), True),
+            # keyset pagination of a user's observations of a species
+            (('user', 'species'), False),
+        )
+
+class ArchivedObservation(BaseModel):
+    """(user, image, species) of observations moved out by archive.py
+    kept in the live database so saves can tell a triple is already counted
+    without attaching the archives
+    """
+    user = ForeignKeyField(User, related_name="archivedobservations")
+    image = ForeignKeyField(Image, related_name="archivedobservations")
+    species = ForeignKeyField(Species, related_name="archivedobservations")
+
+    class Meta:
+        indexes = (
+            # species before image, also serves "has this user archived this species"
+            (('user', 'species', 'image'), True),
+        )
+
+def _in_archive(user, image, species):
+    """True if the (user, image, species) observation has been archived"""
+    return ArchivedObservation.select().where(
+        ArchivedObservation.user == user,
+        ArchivedObservation.species == species,
+        ArchivedObservation.image == image).exists()
+
+def _count_observation(user, image, species, delta):
+    """adjust the counters for one observation, an archived (user, image, species) is
+    already counted and keeps counting, so it is left alone
+    """
+    if not _in_archive(user, image, species):
+        update_counters(user, species, delta)
+
+class IdempotencyKey(BaseModel):
+    """client supplied key for a save request, replays of the same key are ignored
+    keys are only kept for KEY_TTL
+    """
+    key = CharField(max_length=64, unique=True)
+    user = ForeignKeyField(User, related_name="idempotencykeys")
+    observation = ForeignKeyField(Observation, related_name="idempotencykeys", null=True)
+    timestamp = DateTimeField(default=datetime.datetime.now, index=True)
+
+    @classmethod
+    def prune(cls, ttl=KEY_TTL):
+        """delete keys older than ttl, returns the number deleted"""
+        return cls.delete().where(cls.timestamp < datetime.datetime.now() - ttl).execute()
+
+class UserSpeciesCount(BaseModel):
+    """denormalized number of observations per (user, species)"""
+    user = ForeignKeyField(User, related_name="speciescounts")
+    species = ForeignKeyField(Species, related_name="usercounts")
+    total = IntegerField(default=0)
+
+    class Meta:
+        indexes = (
+            (('user', 'species'), True),
+        )
+
+class UserTotal(BaseModel):
+    """denormalized number of observations per user, feeds the leaderboard"""
+    user = ForeignKeyField(User, related_name="totals", unique=True)
+    total = IntegerField(default=0, index=True)
+
+class ImageConsensus(BaseModel):
+    """per image plurality species, written by the reliability job
+    voters and agreed are packed little endian int32 arrays of user ids
+    """
+    image = ForeignKeyField(Image, related_name="consensus", unique=True)
+    species = ForeignKeyField(Species, related_name="consensus")
+    votes = IntegerField(default=0)
+    voters = BlobField()
+    agreed = BlobField()
+    processed_at = DateTimeField(default=datetime.datetime.now, index=True)
+
+class ChangedImage(BaseModel):
+    """images that lost observations since the last reliability run
+    (saves are found by Observation.timestamp, deletes leave no row behind)
+    """
+    image = ForeignKeyField(Image, related_name="changes", unique=True)
+    timestamp = DateTimeField(default=datetime.datetime.now)
+
+    @classmethod
+    def mark(cls, image):
+        """flag an image for rescoring, call inside the deleting transaction"""
+        try:
+            with DATABASE.atomic():
+                cls.create(image=image)
+        except IntegrityError:
+            cls.update(timestamp=datetime.datetime.now()).where(cls.image == image).execute()
+
+class UserReliability(BaseModel):
+    """how often a user agrees with the per image plurality, written by the reliability job"""
+    user = ForeignKeyField(User, related_name="reliability", unique=True)
+    images = IntegerField(default=0)
+    agreements = IntegerField(default=0)
+    agreement_rate = FloatField(default=0.0)
+    # smoothed agreement rate, use as the user's vote weight in aggregations
+    weight = FloatField(default=0.5)
+    updated_at = DateTimeField(default=datetime.datetime.now)
+
+    class Meta:
+        order_by = ('-weight',)
+
+def user_weights(default=0.5):
+    """returns {user_id: weight} for weighting votes, users not yet scored get default"""
+    weights = collections.defaultdict(lambda: default)
+    weights.update(UserReliability.select(UserReliability.user, UserReliability.weight).order_by().tuples())
+    return weights
+
+def update_counters(user, species, delta):
+    """adjust the (user, species) and (user, total) counters by delta
+    call inside the transaction that creates, changes or deletes the observation
+    (Observation.save and delete_instance do)
+    """
+    for model, where, fields in (
+        (UserSpeciesCount, (UserSpeciesCount.user == user, UserSpeciesCount.species == species),
+         {'user': user, 'species': species}),
+        (UserTotal, (UserTotal.user == user,), {'user': user}),
+    ):
+        if not model.update(total=model.total + delta).where(*where).execute():
+            model.create(total=delta, **fields)
+
+def rebuild_counters():
+    """recompute the counter tables from Observation (backfill or after bulk deletes)
+    archived observations are counted too, each (user, image, species) once, read from
+    ArchivedObservation so the archives are not attached
+    """
+    if 'archivedobservation' not in DATABASE.get_tables():
+        # archives made before the table existed
+        import archive
+        archive.record_archived()
+    species_counts = DATABASE.execute_sql(
+        'SELECT user_id, species_id, COUNT(*) FROM ('
+        'SELECT user_id, image_id, species_id FROM observation UNION '
+        'SELECT user_id, image_id, species_id FROM archivedobservation'
+        ') GROUP BY user_id, species_id').fetchall()
+    rows = [{'user': u, 'species': s, 'total': n} for u, s, n in species_counts]
+    totals = {}
+    for row in rows:
+        totals[row['user']] = totals.get(row['user'], 0) + row['total']
+    with DATABASE.atomic():
+        UserSpeciesCount.delete().execute()
+        UserTotal.delete().execute()
+        # keep each insert under sqlite's bound variable limit
+        for start in range(0, len(rows), 100):
+            UserSpeciesCount.insert_many(rows[start:start + 100]).execute()
+        totals = [{'user': u, 'total': n} for u, n in totals.items()]
+        for start in range(0, len(totals), 100):
+            UserTotal.insert_many(totals[start:start + 100]).execute()
+
+def user_species_observations(user, species, before=None, limit=OBS_PAGE_SIZE):
+    """keyset paginated observations of a species by a user, newest first, Image joined
+    pass the id of the last row of a page as before= to get the next page
+    """
+    query = (Observation
+             .select(Observation, Image)
+             .join(Image)
+             .where(Observation.user == user, Observation.species == species)
+             .order_by(Observation.id.desc())
+             .limit(limit))
+    if before:
+        query = query.where(Observation.id < before)
+    return list(query)
+
+def dedupe_observations(batch_size=500):
+    """one-time job, collapse duplicate (user, image, species) observations
+    keeps the most recent row of each group, then adds the unique index
+    """
+    DATABASE.connect()
+    # older databases do not have the tables this job writes to yet
+    DATABASE.create_tables([IdempotencyKey, UserSpeciesCount, UserTotal], safe=True)
+    dupes = (Observation
+             .select(Observation.user, Observation.image, Observation.species,
+                     fn.MAX(Observation.id).alias('keep'))
+             .group_by(Observation.user, Observation.image, Observation.species)
+             .having(fn.COUNT(Observation.id) > 1)
+             .order_by()
+             .tuples())
+    groups = list(dupes)
+    removed = 0
+    for start in range(0, len(groups), batch_size):
+        with DATABASE.atomic():
+            for user_id, image_id, species_id, keep_id in groups[start:start + batch_size]:
+                stale = [o.id for o in Observation.select(Observation.id).where(
+                    Observation.user == user_id,
+                    Observation.image == image_id,
+                    Observation.species == species_id,
+                    Observation.id != keep_id)]
+                IdempotencyKey.update(observation=keep_id).where(
+                    IdempotencyKey.observation << stale).execute()
+                removed += Observation.delete().where(Observation.id << stale).execute()
+        print("{} of {} duplicate groups collapsed".format(min(start + batch_size, len(groups)), len(groups)))
+    # now that rows are unique, existing databases can take the unique index
+    observation_indexes()
+    rebuild_counters()
+    add_index('idempotencykey', ['timestamp'])
+    print("{} expired save keys removed".format(IdempotencyKey.prune()))
+    DATABASE.close()
+    return removed
     
 class Talk(BaseModel):
     """Talk - a table for a note made about an image, goal for this to be searchable"""
@@ -261,7 +703,7 @@ def get_unclassified_image(suggestion=None, max_tries=10000):
     tries = 0
     while seed:
         try:
-            image = Image.get(Image.id==seed)
+            image = Image.get(Image.id==seed, Image.retired==False)
             obs = Observation.select().where(Observation.image==image)
             if len(obs) == 0 or tries > max_tries:
                 # no observations, so we can return it
@@ -274,12 +716,25 @@ def get_unclassified_image(suggestion=None, max_tries=10000):
             # reseed
             seed = randint(30000,IMAGE_COUNT)
         
+# per-process cache of the species table, filled by warm_caches()
+# it is not refreshed by --loadspecies, send SIGHUP to the --serve master to reload workers
+SPECIES_CACHE = None
+
+def warm_caches():
+    """(re)load per-process caches, called in each server worker after fork"""
+    global SPECIES_CACHE
+    DATABASE.connect()
+    try:
+        SPECIES_CACHE = list(Species.select())
+    finally:
+        DATABASE.close()
+
 def species_dict(species=None):
     """produce a nice master dictionary representation of all the species"""
     master = {}
     if species is None:
-        # species called without an existing list, fill the list
-        species = Species.select()
+        # species called without an existing list, use the cache or fill the list
+        species = SPECIES_CACHE if SPECIES_CACHE is not None else Species.select()
     for s in species:
         item = s.__dict__()
         item.update({'id':s.id})
@@ -288,13 +743,13 @@ def species_dict(species=None):
 
 def get_user_stats():
     """returns a list with simplified username and counts"""
-    users = User.select()
-    ustats = []
-    for user in users:
-        uobs = Observation.select().where(
-            Observation.user==user.id
-        )
-        ustats.append((user.username,len(uobs)))
+    # counts come from the UserTotal counter table, not a per-user count of Observation
+    users = (User
+             .select(User.username, fn.COALESCE(UserTotal.total, 0))
+             .join(UserTotal, JOIN.LEFT_OUTER, on=(UserTotal.user == User.id))
+             .order_by()
+             .tuples())
+    ustats = list(users)
     
     # sort by observation count and return
     ustats.sort(key=itemgetter(1), reverse=True)
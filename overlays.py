@@ -0,0 +1,71 @@
+# overlays.py
+# bulk reads of observation overlays as NumPy arrays, e.g. for detection training exports
+#
+# the blob layout is documented next to models.encode_overlay
+import numpy as np
+
+import archive
+from models import OVERLAY_HEADER
+
+
+def decode_many(blobs):
+    """vectorized decode of a list of overlay blobs
+    returns (boxes, box_row, points, point_row) where boxes is (N, 4) int16, points is
+    (M, 2) int16 and *_row gives the index into blobs each box or point came from
+    """
+    blobs = [bytes(b) for b in blobs]
+    empty = (np.zeros((0, 4), np.int16), np.zeros(0, np.intp),
+             np.zeros((0, 2), np.int16), np.zeros(0, np.intp))
+    if not blobs:
+        return empty
+    lengths = np.array([len(b) // 2 for b in blobs], dtype=np.intp)
+    words = np.frombuffer(b''.join(blobs), dtype='<i2')
+    starts = np.r_[0, np.cumsum(lengths)[:-1]]
+    filled = lengths > 0
+    n_boxes = np.zeros(len(blobs), dtype=np.intp)
+    n_points = np.zeros(len(blobs), dtype=np.intp)
+    # header counts are uint16
+    n_boxes[filled] = words[starts[filled]].view('<u2')
+    n_points[filled] = words[starts[filled] + 1].view('<u2')
+    header = OVERLAY_HEADER.size // 2
+
+    def gather(offsets, counts, width):
+        # index of every coordinate, without a Python loop over blobs
+        sizes = counts * width
+        total = int(sizes.sum())
+        begin = np.repeat(offsets - np.r_[0, np.cumsum(sizes)[:-1]], sizes)
+        coords = words[begin + np.arange(total)].reshape(-1, width).astype(np.int16)
+        return coords, np.repeat(np.arange(len(blobs)), counts)
+
+    boxes, box_row = gather(starts + header, n_boxes, 4)
+    points, point_row = gather(starts + header + 4 * n_boxes, n_points, 2)
+    return boxes, box_row, points, point_row
+
+
+def query_overlays(where, params=()):
+    """decode the overlays of observations matching where, live and archived
+    returns a dict of observation, image and species ids per observation plus boxes and
+    points with the row of the observation each belongs to
+    """
+    rows = list(archive.merged_rows('observation', ['id', 'image_id', 'species_id', '_overlay'],
+                                    "typeof(_overlay) = 'blob' AND ({})".format(where), params,
+                                    order_by='id'))
+    boxes, box_row, points, point_row = decode_many([r[3] for r in rows])
+    return {
+        'observation': np.array([r[0] for r in rows], dtype=np.int64),
+        'image': np.array([r[1] for r in rows], dtype=np.int64),
+        'species': np.array([r[2] for r in rows], dtype=np.int64),
+        'boxes': boxes, 'box_row': box_row,
+        'points': points, 'point_row': point_row,
+    }
+
+
+def image_overlays(image):
+    """all overlays drawn on one image"""
+    return query_overlays('image_id = ?', (getattr(image, 'id', image),))
+
+
+def site_overlays(site):
+    """all overlays drawn on images of a site (the first directory of Image.filepath)"""
+    return query_overlays('image_id IN (SELECT id FROM main.image WHERE filepath LIKE ?)',
+                          (site.rstrip('/') + '/%',))
@@ -0,0 +1,188 @@
+# reliability.py
+# volunteer reliability scoring, agreement of each user with the per image plurality
+#
+# run from the command line with: python app.py --reliability [full]
+import datetime
+
+import numpy as np
+
+import archive
+from models import (DATABASE, ChangedImage, Observation, ImageConsensus, UserReliability, fn)
+
+# rows held in memory per batch (always cut on an image boundary)
+BATCH_ROWS = 200000
+# sqlite bound variable limit is 999, keep IN lists and inserts well under it
+CHUNK = 100
+
+
+def smoothed_weight(agreements, images):
+    """Laplace smoothed agreement rate, new users start near 0.5 rather than 0 or 1"""
+    return (agreements + 1.0) / (images + 2.0)
+
+
+def consensus(rows):
+    """vectorized plurality over an (N, 3) int array of (image, user, species) rows
+    returns images, plurality species, plurality votes, voter pairs and agreeing pairs
+    (pairs are (image, user) arrays sorted by image)
+    """
+    rows = np.unique(rows, axis=0)
+    img, usr, spc = rows[:, 0], rows[:, 1], rows[:, 2]
+    # votes per (image, species)
+    pairs, counts = np.unique(rows[:, [0, 2]], axis=0, return_counts=True)
+    # per image, most votes first, ties go to the lowest species id
+    order = np.lexsort((pairs[:, 1], -counts, pairs[:, 0]))
+    pairs, counts = pairs[order], counts[order]
+    first = np.r_[True, pairs[1:, 0] != pairs[:-1, 0]]
+    images, plurality, votes = pairs[first, 0], pairs[first, 1], counts[first]
+    agree = spc == plurality[np.searchsorted(images, img)]
+    voters = np.unique(rows[:, :2], axis=0)
+    agreed = np.unique(rows[agree][:, :2], axis=0)
+    return images, plurality, votes, voters, agreed
+
+
+def _pack(ids):
+    return np.asarray(ids, dtype='<i4').tobytes()
+
+
+def _unpack(blob):
+    return np.frombuffer(bytes(blob), dtype='<i4')
+
+
+def _split(pairs, images):
+    """split sorted (image, user) pairs into one user id array per image"""
+    bounds = np.searchsorted(pairs[:, 0], np.r_[images, images[-1] + 1] if len(images) else images)
+    return [pairs[bounds[n]:bounds[n + 1], 1] for n in range(len(images))]
+
+
+def _bincount(ids, size):
+    return np.bincount(ids, minlength=size)[:size] if len(ids) else np.zeros(size, dtype=np.int64)
+
+
+def process_batch(rows, processed_at, changed=()):
+    """score a batch of complete images, replacing any earlier result for those images
+    images in changed without rows (all observations deleted) lose their earlier result
+    """
+    if len(rows):
+        images, plurality, votes, voters, agreed = consensus(rows)
+    else:
+        images = plurality = votes = np.zeros(0, dtype=np.int64)
+        voters = agreed = np.zeros((0, 2), dtype=np.int64)
+    image_ids = [int(i) for i in images]
+    replaced = sorted(set(image_ids) | set(int(i) for i in changed))
+
+    # previous contribution of these images, to be backed out of the user totals
+    old_voters, old_agreed = [], []
+    for start in range(0, len(replaced), CHUNK):
+        chunk = replaced[start:start + CHUNK]
+        for v, a in (ImageConsensus
+                     .select(ImageConsensus.voters, ImageConsensus.agreed)
+                     .where(ImageConsensus.image << chunk)
+                     .tuples()):
+            old_voters.append(_unpack(v))
+            old_agreed.append(_unpack(a))
+    old_voters = np.concatenate(old_voters) if old_voters else np.zeros(0, dtype=np.int64)
+    old_agreed = np.concatenate(old_agreed) if old_agreed else np.zeros(0, dtype=np.int64)
+
+    size = int(max(voters[:, 1].max() if len(voters) else 0,
+                   old_voters.max() if len(old_voters) else 0)) + 1
+    delta_images = _bincount(voters[:, 1], size) - _bincount(old_voters, size)
+    delta_agreements = _bincount(agreed[:, 1], size) - _bincount(old_agreed, size)
+    touched = np.nonzero((delta_images != 0) | (delta_agreements != 0))[0]
+
+    records = [{'image': image_id, 'species': int(s), 'votes': int(n),
+                'voters': _pack(v), 'agreed': _pack(a), 'processed_at': processed_at}
+               for image_id, s, n, v, a in zip(image_ids, plurality, votes,
+                                               _split(voters, images), _split(agreed, images))]
+
+    with DATABASE.atomic():
+        for start in range(0, len(replaced), CHUNK):
+            ImageConsensus.delete().where(ImageConsensus.image << replaced[start:start + CHUNK]).execute()
+        for start in range(0, len(records), CHUNK):
+            ImageConsensus.insert_many(records[start:start + CHUNK]).execute()
+        for start in range(0, len(touched), CHUNK):
+            chunk = [int(u) for u in touched[start:start + CHUNK]]
+            current = dict((u, (i, a)) for u, i, a in UserReliability.select(
+                UserReliability.user, UserReliability.images, UserReliability.agreements
+            ).where(UserReliability.user << chunk).order_by().tuples())
+            UserReliability.delete().where(UserReliability.user << chunk).execute()
+            scored = []
+            for user_id in chunk:
+                n_images, n_agree = current.get(user_id, (0, 0))
+                n_images += int(delta_images[user_id])
+                n_agree += int(delta_agreements[user_id])
+                if n_images <= 0:
+                    continue
+                scored.append({'user': user_id, 'images': n_images, 'agreements': n_agree,
+                               'agreement_rate': n_agree / float(n_images),
+                               'weight': smoothed_weight(n_agree, n_images),
+                               'updated_at': processed_at})
+            if scored:
+                UserReliability.insert_many(scored).execute()
+    return len(replaced)
+
+
+def _batches(stream, batch_rows=BATCH_ROWS):
+    """stream image ordered (image, user, species) tuples as arrays of complete images"""
+    rows = []
+    for row in stream:
+        if len(rows) >= batch_rows and row[0] != rows[-1][0]:
+            yield np.array(rows, dtype=np.int64)
+            rows = []
+        rows.append(row)
+    if rows:
+        yield np.array(rows, dtype=np.int64)
+
+
+def _observations(where='', params=()):
+    """(image, user, species) rows from the live and archive databases, ordered by image"""
+    return archive.merged_rows('observation', ['image_id', 'user_id', 'species_id'],
+                               where, params, order_by='image_id')
+
+
+def run(full=False, batch_rows=BATCH_ROWS):
+    """score volunteers, by default only images with observations saved since the last run
+    or deleted since (ChangedImage)
+    returns the number of images processed
+    """
+    started = datetime.datetime.now()
+    DATABASE.connect()
+    try:
+        since = None
+        if not full:
+            since = ImageConsensus.select(fn.MAX(ImageConsensus.processed_at)).scalar()
+        if since is None:
+            # first or full run, start from scratch and stream everything by image
+            with DATABASE.atomic():
+                ImageConsensus.delete().execute()
+                UserReliability.delete().execute()
+                ChangedImage.delete().where(ChangedImage.timestamp < started).execute()
+            batches = ((rows, ()) for rows in _batches(_observations(), batch_rows))
+        else:
+            saved = set(i for i, in (Observation
+                                     .select(Observation.image)
+                                     .where(Observation.timestamp >= since)
+                                     .group_by(Observation.image)
+                                     .order_by()
+                                     .tuples()))
+            deleted = set(i for i, in ChangedImage.select(ChangedImage.image).tuples())
+            changed = sorted(saved | deleted)
+            # the IN list is repeated for every attached archive, keep the total under
+            # sqlite's bound variable limit
+            step = min(CHUNK, 900 // (len(archive.archive_paths()) + 1))
+            batches = ((np.array(list(_observations(
+                            'image_id IN ({})'.format(', '.join('?' * len(changed[start:start + step]))),
+                            changed[start:start + step])), dtype=np.int64).reshape(-1, 3),
+                        changed[start:start + step])
+                       for start in range(0, len(changed), step))
+        processed = 0
+        for rows, chunk in batches:
+            if len(rows) or len(chunk):
+                processed += process_batch(rows, started, chunk)
+                if len(chunk):
+                    # marks made after the run started are picked up next time
+                    ChangedImage.delete().where(ChangedImage.image << list(chunk),
+                                                ChangedImage.timestamp < started).execute()
+                print("{} images scored".format(processed))
+        return processed
+    finally:
+        DATABASE.close()